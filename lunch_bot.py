@@ -19,6 +19,13 @@ Environment variables required:
 Optional env vars:
     USER_ID_ADMIN              # LINE user ID for push
     FALLBACK_LAT / FALLBACK_LNG
+    HISTORY_FLUSH_SECONDS      # 「就吃這家」批次寫入間隔（預設 2s）
+    HISTORY_MAX_PENDING        # 緩衝筆數達上限立即寫入（預設 200）
+    KEYWORD_CACHE_HOURS        # 搜尋關鍵字 fallback 結果快取時效（預設 24h）
+    PROFILE_SAMPLE_EVERY       # 每 N 個 /callback 做一次堆疊取樣 profiling（0 = 關閉）
+    PROFILE_ADMIN_TOKEN        # 帶 X-Profile-Token 強制取樣 / 讀 /admin/profile
+    PROFILE_DIR / PROFILE_KEEP # 每小時彙整的 .prof 檔位置與保留份數（至少 1）
+    WARMUP_HOUR / WARMUP_MINUTE  # 午餐尖峰前的快取預熱時間（預設 11:15）
 
 Run locally:
 $ ngrok http 8000
@@ -27,10 +34,19 @@ $ python lunch_bot.py
 
 from __future__ import annotations
 
+import atexit
+import hmac
+import io
+import itertools
 import logging
 import os
+import pstats
 import sqlite3
+import sys
+import threading
 import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from typing import Any, List, Tuple
@@ -48,7 +64,7 @@ from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 from linebot.models import FlexSendMessage, CarouselContainer, BubbleContainer, PostbackEvent
 
-from collections import defaultdict
+from collections import Counter, defaultdict
 from linebot.models import QuickReply, QuickReplyButton, MessageAction
 
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -74,6 +90,7 @@ category_map = {
 # --------------------------- Config -----------------------------------------
 DB_PATH = Path("lunch.db")
 RADIUS_METERS = 700  # ≈8‑minute walk
+RECENT_DAYS = 3      # 幾天內選過的店不再推薦
 COMPANY_PLUS_CODE = "5JJ8+QQ 福和里 台中市西屯區"
 
 GOOGLE_KEY = os.getenv("GOOGLE_API_KEY")
@@ -84,6 +101,28 @@ ADMIN_USER_ID = os.getenv("USER_ID_ADMIN")
 FALLBACK_LAT = os.getenv("FALLBACK_LAT")
 FALLBACK_LNG = os.getenv("FALLBACK_LNG")
 
+# 「就吃這家」寫入緩衝：最多累積幾秒 / 幾筆就寫回 user_history
+HISTORY_FLUSH_SECONDS = int(os.getenv("HISTORY_FLUSH_SECONDS", 2))
+HISTORY_MAX_PENDING = int(os.getenv("HISTORY_MAX_PENDING", 200))
+
+# 「搜尋 關鍵字」線上 fallback 結果快取時效
+KEYWORD_CACHE_TTL = timedelta(hours=int(os.getenv("KEYWORD_CACHE_HOURS", 24)))
+
+# 線上效能取樣（預設關閉）
+PROFILE_SAMPLE_EVERY = int(os.getenv("PROFILE_SAMPLE_EVERY", 0))
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "profiles"))
+PROFILE_KEEP = max(1, int(os.getenv("PROFILE_KEEP", 24)))
+PROFILE_DUMP_SECONDS = 60
+PROFILE_INTERVAL = 0.001   # 堆疊取樣間隔（秒）
+
+# 午餐尖峰（約 11:30–12:30）前預熱快取
+WARMUP_HOUR = int(os.getenv("WARMUP_HOUR", 11))
+WARMUP_MINUTE = int(os.getenv("WARMUP_MINUTE", 15))
+# recent_place_ids() 用「現在往回 RECENT_DAYS×24h」的滾動區間，每人每天一筆：
+# 最多涵蓋 RECENT_DAYS + 1 個日期（含今天已選），預熱要往下多涵蓋這麼多名
+WARMUP_DEPTH = 5 + RECENT_DAYS + 1
+
 if not all([GOOGLE_KEY, LINE_SECRET, LINE_TOKEN]):
     raise RuntimeError("Missing GOOGLE_API_KEY / LINE creds in environment.")
 
@@ -127,11 +166,19 @@ def init_db() -> None:
                 chosen_at TEXT
             )"""
         )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS keyword_cache (
+                keyword TEXT PRIMARY KEY,
+                place_ids TEXT,
+                cached_at TEXT
+            )"""
+        )
         conn.commit()
 
 # ---------------------- Google API helpers ----------------------------------
 GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
 PLACES_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+PHOTO_URL = "https://maps.googleapis.com/maps/api/place/photo"
 
 # 針對多個餐飲相關類型輪詢，避免單次 API 只回 restaurant 導致遺漏
 TYPES_OF_INTEREST = [
@@ -199,6 +246,66 @@ def fetch_places(lat: float, lng: float) -> List[dict[str, Any]]:
     logging.info("Fetched %d unique places (all types).", len(seen))
     return list(seen.values())
 
+_company_coords: Tuple[float, float] | None = None
+
+def company_location() -> Tuple[float, float]:
+    """
+    Geocode COMPANY_PLUS_CODE, keeping the result for the process lifetime.
+    FALLBACK_LAT/LNG (returned when geocoding fails) are not kept, so the next
+    call retries the real geocode.
+    """
+    global _company_coords
+    if _company_coords is not None:
+        return _company_coords
+    lat_lng = geocode_plus_code(COMPANY_PLUS_CODE)
+    if not (FALLBACK_LAT and FALLBACK_LNG
+            and lat_lng == (float(FALLBACK_LAT), float(FALLBACK_LNG))):
+        _company_coords = lat_lng
+    return lat_lng
+
+def fetch_keyword_places(lat: float, lng: float,
+                         keyword: str) -> Tuple[List[dict[str, Any]], bool]:
+    """
+    S2-3 keyword fallback: `type=<t>&keyword=<dish>` for every TYPES_OF_INTEREST,
+    queried concurrently (first page only – this runs inside a webhook reply).
+    Returns (places, complete); a failing type is logged and skipped, and
+    `complete` is False if any type failed.
+    """
+    base_params = {
+        "key": GOOGLE_KEY,
+        "location": f"{lat},{lng}",
+        "radius": RADIUS_METERS,
+        "language": "zh-TW",
+        "keyword": keyword,
+    }
+
+    def _one(t: str) -> List[dict[str, Any]] | None:
+        try:
+            payload = _safe_get(PLACES_URL, **(base_params | {"type": t}))
+        except requests.RequestException as exc:
+            logging.warning("Keyword %r / type %s failed: %s", keyword, t, exc)
+            return None
+        status = payload.get("status")
+        if status not in {"OK", "ZERO_RESULTS"}:
+            logging.warning("Keyword %r / type %s: Places API error: %s – %s",
+                            keyword, t, status, payload.get("error_message"))
+            return None
+        return payload.get("results", [])
+
+    seen: dict[str, dict[str, Any]] = {}
+    complete = True
+    with ThreadPoolExecutor(max_workers=len(TYPES_OF_INTEREST)) as pool:
+        for results in pool.map(_one, TYPES_OF_INTEREST):
+            if results is None:
+                complete = False
+                continue
+            for place in results:
+                seen.setdefault(place["place_id"], place)
+
+    logging.info("Keyword %r ⇒ %d unique places%s.", keyword, len(seen),
+                 "" if complete else " (partial)")
+    return list(seen.values()), complete
+
 # ---------------------- Data persistence ------------------------------------
 
 def upsert_places(places: List[dict[str, Any]]) -> List[str]:
@@ -251,6 +358,181 @@ def upsert_places(places: List[dict[str, Any]]) -> List[str]:
         conn.commit()
     return new_names
 
+def normalize_keyword(keyword: str) -> str:
+    """全形/半形、大小寫、多餘空白都視為同一關鍵字。"""
+    return " ".join(unicodedata.normalize("NFKC", keyword).lower().split())
+
+def cached_keyword_ids(keyword: str) -> set[str] | None:
+    """Return cached place_ids for `keyword`, or None if missing / expired."""
+    cutoff = (datetime.utcnow() - KEYWORD_CACHE_TTL).isoformat()
+    with sqlite3.connect(DB_PATH) as conn:
+        row = conn.execute(
+            "SELECT place_ids FROM keyword_cache WHERE keyword=? AND cached_at>=?",
+            (keyword, cutoff),
+        ).fetchone()
+    if row is None:
+        return None
+    return set(row[0].split(",")) if row[0] else set()
+
+def cache_keyword_ids(keyword: str, place_ids: set[str]) -> None:
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO keyword_cache (keyword, place_ids, cached_at) VALUES (?,?,?)",
+            (keyword, ",".join(sorted(place_ids)), datetime.utcnow().isoformat()),
+        )
+        conn.commit()
+
+def keyword_fallback(keyword: str) -> set[str]:
+    """
+    place_ids matching `keyword` when the local LIKE search finds nothing.
+    Served from keyword_cache while fresh; otherwise query Google, merge the
+    results into `places` and cache them (empty results too, so unknown
+    keywords don't hit the API on every search). Partial results – some
+    type failed – are returned but not cached.
+    """
+    norm = normalize_keyword(keyword)
+    cached = cached_keyword_ids(norm)
+    if cached is not None:
+        logging.debug("Keyword cache hit: %r ⇒ %d places", norm, len(cached))
+        return cached
+
+    try:
+        lat, lng = company_location()
+        places, complete = fetch_keyword_places(lat, lng, norm)
+        upsert_places(places)
+    except Exception as exc:
+        logging.error("Keyword fallback failed: %s", exc)
+        return set()
+
+    place_ids = {p["place_id"] for p in places}
+    if complete:
+        cache_keyword_ids(norm, place_ids)
+    return place_ids
+
+# ---------------------- user_history write-behind ---------------------------
+# 午餐尖峰時「就吃這家」會瞬間湧入大量小寫入，各自搶 SQLite write lock。
+# 改成先記在記憶體（每位使用者每天只留最後一次選擇），再由背景排程批次寫回。
+# 程式崩潰時最多遺失 HISTORY_FLUSH_SECONDS 秒 / HISTORY_MAX_PENDING 筆；
+# DB 持續寫入失敗時佇列會超過上限，此時以 critical log 告警。
+
+# (user_id, 本地日期) → (place_id, chosen_at)
+_pending_choices: dict[Tuple[str, str], Tuple[str, str]] = {}
+# 正在寫回 DB、尚未 commit 的批次（讀取時仍要看得到）
+_inflight_choices: dict[Tuple[str, str], Tuple[str, str]] = {}
+# 已寫回 DB 的當日選擇，用來判斷「記錄過了」；None 表示 DB 當天沒有紀錄
+_flushed_choices: dict[Tuple[str, str], str | None] = {}
+_choices_lock = threading.Lock()
+# 同一時間只允許一個 flush，避免舊批次晚於新批次 commit 而蓋掉最新選擇
+_flush_lock = threading.Lock()
+# 上次 flush 失敗時，改由排程重試，webhook 不再自行 flush
+_flush_failing = False
+
+
+def _recorded_choice(key: Tuple[str, str]) -> str | None:
+    """Today's flushed choice for `key`, read from user_history on a cache miss."""
+    with _choices_lock:
+        if key in _flushed_choices:
+            return _flushed_choices[key]
+    user_id, day = key
+    with sqlite3.connect(DB_PATH) as conn:
+        row = conn.execute(
+            "SELECT place_id FROM user_history WHERE user_id=? AND date(chosen_at)=? "
+            "ORDER BY chosen_at DESC LIMIT 1",
+            (user_id, day),
+        ).fetchone()
+    with _choices_lock:
+        # flush 期間若已寫入較新的值，以 flush 為準
+        return _flushed_choices.setdefault(key, row[0] if row else None)
+
+
+def record_choice(user_id: str, place_id: str) -> bool:
+    """
+    Queue today's choice for `user_id`; return False if it is already recorded.
+    Only the latest choice per (user, day) is kept.
+    """
+    key = (user_id, datetime.now().date().isoformat())
+    with _choices_lock:
+        queued = _pending_choices.get(key) or _inflight_choices.get(key)
+    current = queued[0] if queued else _recorded_choice(key)
+    if current == place_id:
+        return False
+
+    with _choices_lock:
+        _pending_choices[key] = (place_id, datetime.utcnow().isoformat())
+        backlog = len(_pending_choices)
+
+    if backlog >= HISTORY_MAX_PENDING and not _flush_failing:
+        # 已有 flush 在跑就交給排程，不讓 webhook 執行緒排隊等鎖
+        flush_choices(blocking=False)
+    return True
+
+
+def flush_choices(blocking: bool = True) -> None:
+    """
+    Write all pending choices to `user_history` in one transaction.
+    With blocking=False, return at once if another flush is running.
+    """
+    global _flush_failing
+    if not _flush_lock.acquire(blocking=blocking):
+        return
+    try:
+        with _choices_lock:
+            if not _pending_choices:
+                return
+            batch = dict(_pending_choices)
+            _inflight_choices.update(batch)
+            _pending_choices.clear()
+
+        try:
+            with sqlite3.connect(DB_PATH) as conn:
+                conn.executemany(
+                    "DELETE FROM user_history WHERE user_id=? AND date(chosen_at)=?",
+                    [(user_id, day) for user_id, day in batch],
+                )
+                conn.executemany(
+                    "INSERT INTO user_history (user_id, place_id, chosen_at) VALUES (?,?,?)",
+                    [(user_id, place_id, chosen_at)
+                     for (user_id, _), (place_id, chosen_at) in batch.items()],
+                )
+                conn.commit()
+        except sqlite3.Error as exc:
+            logging.error("History flush failed, will retry: %s", exc)
+            _flush_failing = True
+            with _choices_lock:
+                # 失敗時放回佇列，但不覆蓋期間新進的選擇
+                for key, value in batch.items():
+                    _pending_choices.setdefault(key, value)
+                _inflight_choices.clear()
+                backlog = len(_pending_choices)
+            if backlog >= HISTORY_MAX_PENDING:
+                logging.critical(
+                    "user_history unwritable: %d choices held only in memory "
+                    "and will be lost on crash.", backlog)
+            return
+
+        _flush_failing = False
+        today = datetime.now().date().isoformat()
+        with _choices_lock:
+            _inflight_choices.clear()
+            for key in [k for k in _flushed_choices if k[1] != today]:
+                del _flushed_choices[key]
+            for key, (place_id, _) in batch.items():
+                if key[1] == today:
+                    _flushed_choices[key] = place_id
+    finally:
+        _flush_lock.release()
+    logging.debug("Flushed %d choices to user_history.", len(batch))
+
+
+def pending_choices_for(user_id: str) -> dict[str, Tuple[str, str]]:
+    """Return {day: (place_id, chosen_at)} not yet committed for `user_id`."""
+    with _choices_lock:
+        merged = _inflight_choices | _pending_choices
+    return {day: value for (uid, day), value in merged.items() if uid == user_id}
+
+
+atexit.register(flush_choices)
+
 # ---------------------- Scheduler job ---------------------------------------
 
 def daily_refresh() -> None:
@@ -271,6 +553,8 @@ def daily_refresh() -> None:
         logging.info("No new restaurants today.")
 
 scheduler.add_job(daily_refresh, "cron", hour=10, minute=0, id="daily_refresh")
+scheduler.add_job(flush_choices, "interval", seconds=HISTORY_FLUSH_SECONDS,
+                  id="flush_choices", coalesce=True, max_instances=1)
 
 # -------------------- LINE build_bubble --------------------------------- 
 # ---------- Star icon URLs ----------
@@ -427,6 +711,222 @@ def build_bubble(
 
     return BubbleContainer.new_from_json_dict(bubble)
 
+# 預熱快取：warm_up() 每天另建一份再整份換上，回覆時命中就不必再組 Bubble
+_photo_url_cache: dict[str, str] = {}      # photo_ref → 已解析的圖片直連網址
+_bubble_cache: dict[tuple, BubbleContainer] = {}  # query_places() row → Bubble
+
+def resolve_photo_url(photo_ref: str) -> str | None:
+    """Follow the Places Photo redirect once and return the final image URL."""
+    resp = requests.get(
+        PHOTO_URL,
+        params={"maxwidth": 240, "photoreference": photo_ref, "key": GOOGLE_KEY},
+        allow_redirects=False,
+        timeout=10,
+    )
+    return resp.headers.get("Location") if resp.is_redirect else None
+
+def photo_url_for(photo_ref: str | None,
+                  photo_urls: dict[str, str] | None = None) -> str:
+    if not photo_ref:
+        return PLACEHOLDER_URL
+    cache = _photo_url_cache if photo_urls is None else photo_urls
+    return cache.get(photo_ref) or (
+        f"{PHOTO_URL}?maxwidth=240&photoreference={photo_ref}&key={GOOGLE_KEY}"
+    )
+
+def _row_bubble(row: tuple, photo_urls: dict[str, str] | None = None) -> BubbleContainer:
+    (place_id, name, rating, address,
+     lat, lng,
+     open_now, opening_hours, photo_ref) = row
+    return build_bubble(
+        place_id=place_id,
+        name=name,
+        rating=rating,
+        address=address,
+        lat=lat,
+        lng=lng,
+        open_now=bool(open_now) if open_now is not None else None,
+        opening_hours=opening_hours,
+        photo_url=photo_url_for(photo_ref, photo_urls),
+    )
+
+def bubble_for_row(row: tuple) -> BubbleContainer:
+    """Build (or reuse) the Bubble for one query_places() row."""
+    bubble = _bubble_cache.get(row)
+    if bubble is None:
+        bubble = _bubble_cache[row] = _row_bubble(row)
+    return bubble
+
+# -------------------- Request profiling -------------------------------------
+# 每 PROFILE_SAMPLE_EVERY 個 /callback（或帶 admin header 的請求）做堆疊取樣，
+# 結果累加到「啟動以來」與「每小時」Stats；每小時那份由排程寫到 PROFILE_DIR，
+# 不在 webhook 執行緒做磁碟 I/O。
+
+_profile_counter = itertools.count(1)
+_profile_busy = threading.Lock()   # 同一時間只取樣一個請求，限制額外負擔
+_profile_lock = threading.Lock()
+_profile_total = pstats.Stats()
+_profile_windows: dict[str, pstats.Stats] = {}  # 小時 → 尚未寫檔的彙整
+_profile_dirty: set[str] = set()
+
+
+class StackSampler:
+    """
+    Poll one thread's stack every PROFILE_INTERVAL seconds.
+
+    cProfile on Python 3.12+ (sys.monitoring) records calls from every thread,
+    so other requests and scheduler jobs would leak into the profile. Here only
+    the calling thread is sampled via sys._current_frames(). create_stats()
+    yields cProfile-style stats, so pstats.Stats can load and merge it;
+    ncalls there are sample counts and times are sampled wall-clock estimates.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.counts: Counter[tuple] = Counter()    # stack (外→內) → 取樣次數
+        self.seconds: Counter[tuple] = Counter()   # stack → 累計秒數
+        self._stop = threading.Event()
+
+    def runcall(self, func, *args):
+        poller = threading.Thread(target=self._poll, args=(threading.get_ident(),),
+                                  name="stack-sampler", daemon=True)
+        poller.start()
+        try:
+            return func(*args)
+        finally:
+            self._stop.set()
+            poller.join()
+
+    def _poll(self, target: int) -> None:
+        stop_code = StackSampler.runcall.__code__
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            now = time.perf_counter()
+            stack = []
+            # 只收 runcall 以下的 frame（不含 Flask / werkzeug 外層）
+            while frame is not None and frame.f_code is not stop_code:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                key = tuple(reversed(stack))
+                self.counts[key] += 1
+                self.seconds[key] += now - last
+            last = now
+
+    def create_stats(self) -> None:
+        # pstats 格式：func → (cc, nc, tt, ct, {caller: (cc, nc, tt, ct)})
+        stats: dict[tuple, tuple] = {}
+        for stack, n in self.counts.items():
+            t = self.seconds[stack]
+            seen: set[tuple] = set()
+            for depth, func in enumerate(stack):
+                leaf = depth == len(stack) - 1
+                first = func not in seen   # 遞迴只算一次 cumulative
+                seen.add(func)
+                cc, nc, tt, ct, callers = stats.get(func, (0, 0, 0.0, 0.0, {}))
+                if depth:
+                    c = callers.get(stack[depth - 1], (0, 0, 0.0, 0.0))
+                    callers[stack[depth - 1]] = (c[0] + n, c[1] + n,
+                                                 c[2] + (t if leaf else 0.0), c[3] + t)
+                stats[func] = (cc + (n if first else 0), nc + n,
+                               tt + (t if leaf else 0.0), ct + (t if first else 0.0),
+                               callers)
+        self.stats = stats
+
+
+def has_admin_token() -> bool:
+    token = request.headers.get("X-Profile-Token", "")
+    return bool(PROFILE_ADMIN_TOKEN) and hmac.compare_digest(
+        token.encode(), PROFILE_ADMIN_TOKEN.encode()
+    )
+
+
+def should_profile() -> bool:
+    if has_admin_token():
+        return True
+    return PROFILE_SAMPLE_EVERY > 0 and next(_profile_counter) % PROFILE_SAMPLE_EVERY == 0
+
+
+def record_profile(prof: StackSampler) -> None:
+    """Merge one request's profile into the in-memory aggregates."""
+    hour = datetime.now().strftime("%Y%m%d-%H")
+    with _profile_lock:
+        _profile_total.add(prof)
+        _profile_windows.setdefault(hour, pstats.Stats()).add(prof)
+        _profile_dirty.add(hour)
+
+
+def dump_profiles() -> None:
+    """
+    Write changed hourly aggregates to PROFILE_DIR and rotate old files.
+    An hour that fails to write stays dirty (and in memory) for the next run.
+    """
+    current = datetime.now().strftime("%Y%m%d-%H")
+    with _profile_lock:
+        snapshots = {}
+        for hour in _profile_dirty:
+            snapshots[hour] = pstats.Stats()
+            snapshots[hour].add(_profile_windows[hour])
+        _profile_dirty.clear()
+
+    written: set[str] = set()
+    try:
+        if snapshots:
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        for hour, stats in snapshots.items():
+            stats.dump_stats(PROFILE_DIR / f"callback-{hour}.prof")
+            written.add(hour)
+        if written:
+            for old in sorted(PROFILE_DIR.glob("callback-*.prof"))[:-PROFILE_KEEP]:
+                old.unlink()
+    except OSError as exc:
+        logging.warning("Cannot write profile: %s", exc)
+
+    with _profile_lock:
+        _profile_dirty.update(set(snapshots) - written)
+        # 過去的小時寫檔成功後就不會再變，不必留在記憶體
+        for hour in [h for h in _profile_windows
+                     if h != current and h not in _profile_dirty]:
+            del _profile_windows[hour]
+
+
+scheduler.add_job(dump_profiles, "interval", seconds=PROFILE_DUMP_SECONDS,
+                  id="dump_profiles", coalesce=True, max_instances=1)
+atexit.register(dump_profiles)
+
+
+def run_profiled(func, *args):
+    """Call func(*args), stack-sampled if this request is selected."""
+    if not should_profile() or not _profile_busy.acquire(blocking=False):
+        return func(*args)
+    prof = StackSampler()
+    try:
+        return prof.runcall(func, *args)
+    finally:
+        _profile_busy.release()
+        if prof.counts:   # 太快的請求可能一次都沒取樣到
+            record_profile(prof)
+
+
+@app.route("/admin/profile", methods=["GET"])
+def admin_profile():
+    # Top cumulative hot spots since startup; ?top=N 調整筆數
+    if not has_admin_token():
+        abort(403)
+    top = request.args.get("top", 30, type=int)
+    buf = io.StringIO()
+    with _profile_lock:
+        if not _profile_total.stats:
+            return "No profiled requests yet.", 200, {"Content-Type": "text/plain; charset=utf-8"}
+        stats = pstats.Stats(stream=buf)
+        stats.add(_profile_total)
+    buf.write(f"Stack samples every {PROFILE_INTERVAL * 1000:g} ms; "
+              "ncalls = samples, times are estimates.\n")
+    stats.sort_stats("cumulative").print_stats(top)
+    return buf.getvalue(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
 # -------------------- LINE webhook handlers ---------------------------------
 
 @app.route("/callback", methods=["POST"])
@@ -434,7 +934,7 @@ def callback():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
     try:
-        handler.handle(body, signature)
+        run_profiled(handler.handle, body, signature)
     except InvalidSignatureError:
         abort(400)
     return "OK"
@@ -521,32 +1021,14 @@ def handle_postback(event: PostbackEvent):
     user_id = event.source.user_id
     if data.startswith("chosen:"):
         place_id = data.split(":", 1)[1]
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            # Check whether today already has a record for this user
-            cur.execute(
-                "SELECT place_id FROM user_history "
-                "WHERE user_id=? AND date(chosen_at)=date('now','localtime')",
-                (user_id,)
+        # 先回覆使用者，實際寫入交給 flush_choices() 批次處理
+        if not record_choice(user_id, place_id):
+            # Same place already recorded today; ignore duplicate
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text="記錄過了！")
             )
-            row = cur.fetchone()
-            if row and row[0] == place_id:
-                # Same place already recorded today; ignore duplicate
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="記錄過了！")
-                )
-                return
-            # Otherwise, replace today's previous choice (if any) with the new one
-            cur.execute(
-                "DELETE FROM user_history WHERE user_id=? AND date(chosen_at)=date('now','localtime')",
-                (user_id,)
-            )
-            cur.execute(
-                "INSERT INTO user_history (user_id, place_id, chosen_at) VALUES (?,?,?)",
-                (user_id, place_id, datetime.utcnow().isoformat())
-            )
-            conn.commit()
+            return
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="已記錄！祝用餐愉快 😋")
@@ -557,7 +1039,9 @@ def query_places(keyword: str | None = None,
                  zh_category: str | None = None,
                  price_max: int | None = None,
                  exclude_ids: set[str] | None = None,
-                 type_key: str | None = None):
+                 type_key: str | None = None,
+                 place_ids: set[str] | None = None,
+                 limit: int = 5):
     sql = """SELECT place_id, name, rating, address, lat, lng, open_now, opening_hours, photo_ref
              FROM places"""
     cond, params = [], []
@@ -580,6 +1064,14 @@ def query_places(keyword: str | None = None,
         cond.append("price_level<=?")
         params.append(price_max)
 
+    # 限定候選（keyword fallback 結果）
+    if place_ids is not None:
+        if not place_ids:
+            return []
+        placeholders = ",".join("?" for _ in place_ids)
+        cond.append(f"place_id IN ({placeholders})")
+        params.extend(place_ids)
+
     if exclude_ids:
         placeholders = ",".join("?" for _ in exclude_ids)
         cond.append(f"place_id NOT IN ({placeholders})")
@@ -587,17 +1079,23 @@ def query_places(keyword: str | None = None,
 
     if cond:
         sql += " WHERE " + " AND ".join(cond)
-    sql += " ORDER BY rating DESC NULLS LAST, user_ratings_total DESC LIMIT 5"
+    sql += " ORDER BY rating DESC NULLS LAST, user_ratings_total DESC LIMIT ?"
+    params.append(limit)
 
     with sqlite3.connect(DB_PATH) as conn:
         return conn.execute(sql, params).fetchall()
 
 # Helper: fetch recent choices
-def recent_place_ids(user_id: str, days: int = 3) -> set[str]:
+def recent_place_ids(user_id: str, days: int = RECENT_DAYS) -> set[str]:
     cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
-    sql = "SELECT place_id FROM user_history WHERE user_id=? AND chosen_at>=?"
+    sql = "SELECT place_id, chosen_at FROM user_history WHERE user_id=? AND chosen_at>=?"
+    pending = pending_choices_for(user_id)
     with sqlite3.connect(DB_PATH) as conn:
-        return {row[0] for row in conn.execute(sql, (user_id, cutoff))}
+        # 尚未寫回的當日選擇會取代 DB 內同一天的舊紀錄
+        ids = {place_id for place_id, chosen_at in conn.execute(sql, (user_id, cutoff))
+               if chosen_at[:10] not in pending}
+    ids.update(place_id for place_id, chosen_at in pending.values() if chosen_at >= cutoff)
+    return ids
 
 def reply_best(event: MessageEvent, keyword: str | None = None):
     user_id = event.source.user_id
@@ -611,6 +1109,11 @@ def reply_best(event: MessageEvent, keyword: str | None = None):
     rows = query_places(keyword, category, price_max,
                         exclude_ids=exclude_ids, type_key=type_key)
 
+    # 本地找不到 → 線上 keyword fallback（結果會快取，之後同關鍵字直接查本地）
+    if not rows and keyword:
+        rows = query_places(None, category, price_max, exclude_ids=exclude_ids,
+                            type_key=type_key, place_ids=keyword_fallback(keyword))
+
     # 用完就清 session
     user_session.pop(user_id, None)
 
@@ -622,37 +1125,71 @@ def reply_best(event: MessageEvent, keyword: str | None = None):
         return
 
     # --- 1) 把每一筆資料轉成 Bubble ---
-    bubbles: list[BubbleContainer] = []
-    for row in rows:
-        (place_id, name, rating, address,
-        lat, lng,
-        open_now, opening_hours, photo_ref) = row
-
-        photo_url = (f"https://maps.googleapis.com/maps/api/place/photo"
-                    f"?maxwidth=240&photoreference={photo_ref}&key={GOOGLE_KEY}"
-                    if photo_ref else PLACEHOLDER_URL)
-
-        # TODO: When user explicitly selects a restaurant, insert into user_history.
-
-        bubbles.append(
-            build_bubble(
-                place_id=place_id,
-                name=name,
-                rating=rating,
-                address=address,
-                lat=lat,
-                lng=lng,
-                open_now=bool(open_now) if open_now is not None else None,
-                opening_hours=opening_hours,
-                photo_url=photo_url
-            )
-        )
+    bubbles: list[BubbleContainer] = [bubble_for_row(row) for row in rows]
 
     # --- 2) 組成 Carousel & 發送 Flex ---
     carousel = CarouselContainer(contents=bubbles)
     flex_msg = FlexSendMessage(alt_text="午餐推薦", contents=carousel)
     line_bot_api.reply_message(event.reply_token, flex_msg)
 
+# ---------------------- Pre-lunch warm-up -----------------------------------
+
+def warm_up() -> None:
+    """
+    Run every category_map × budget_map query before the lunch rush so the DB
+    pages are hot, resolve their photo URLs and pre-render their Bubbles.
+    Each combo is warmed WARMUP_DEPTH deep, since reply_best() excludes the
+    user's recent choices and pulls lower-ranked rows up. New caches are built
+    aside and swapped in at the end, so replies during the warm-up don't
+    cache bubbles with unresolved photo URLs.
+    """
+    global _photo_url_cache, _bubble_cache
+    started = time.perf_counter()
+    photo_urls: dict[str, str] = {}
+
+    try:
+        rows: dict[tuple, None] = {}
+        combos = [(None, None, None)] + [
+            (zh_cat, type_key, price_max)
+            for zh_cat, type_key in category_map.items()
+            for price_max in budget_map.values()
+        ]
+        for zh_cat, type_key, price_max in combos:
+            rows.update(dict.fromkeys(query_places(None, zh_cat, price_max,
+                                                   type_key=type_key, limit=WARMUP_DEPTH)))
+
+        # recent_place_ids() 每次都掃 user_history，先讀一遍
+        with sqlite3.connect(DB_PATH) as conn:
+            conn.execute("SELECT COUNT(*), MAX(chosen_at) FROM user_history").fetchone()
+
+        photo_refs = {row[-1] for row in rows if row[-1]}
+
+        def _resolve(ref: str) -> None:
+            try:
+                url = resolve_photo_url(ref)
+            except requests.RequestException as exc:
+                logging.debug("Photo prefetch failed for %s: %s", ref, exc)
+                return
+            if url:
+                photo_urls[ref] = url
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(_resolve, photo_refs))
+
+        bubbles = {row: _row_bubble(row, photo_urls) for row in rows}
+    except Exception as exc:
+        logging.error("Warm-up failed: %s", exc)
+        return
+
+    _photo_url_cache, _bubble_cache = photo_urls, bubbles
+    logging.info(
+        "Warm-up done in %.2fs: %d combos, %d places, %d/%d photos, %d bubbles.",
+        time.perf_counter() - started, len(combos), len(rows),
+        len(photo_urls), len(photo_refs), len(bubbles),
+    )
+
+scheduler.add_job(warm_up, "cron", hour=WARMUP_HOUR, minute=WARMUP_MINUTE, id="warm_up")
+
 # --------------------------- Main -------------------------------------------
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+"""Tests for the 「就吃這家」 write-behind buffer (record_choice / flush_choices).
+
+Run:
+$ python -m pytest -q test_history_buffer.py
+
+Uses a temporary SQLite file; the real `lunch.db` is never touched.
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+for mod in ("flask", "linebot", "requests", "apscheduler"):
+    pytest.importorskip(mod)
+
+ROOT = Path(__file__).resolve().parent
+sys.path.append(str(ROOT))
+
+# lunch_bot 在 import 時就檢查憑證並啟動排程；給假值並拉長自動 flush 間隔
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ["HISTORY_FLUSH_SECONDS"] = "3600"
+
+import lunch_bot as lunch  # noqa: E402
+
+_real_connect = sqlite3.connect
+
+
+@pytest.fixture(autouse=True)
+def temp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(lunch, "DB_PATH", tmp_path / "lunch.db")
+    lunch.init_db()
+    yield
+    for buf in (lunch._pending_choices, lunch._inflight_choices, lunch._flushed_choices):
+        buf.clear()
+    lunch._flush_failing = False
+
+
+def history_rows(user_id: str) -> list[tuple]:
+    with _real_connect(lunch.DB_PATH) as conn:
+        return conn.execute(
+            "SELECT place_id FROM user_history WHERE user_id=?", (user_id,)
+        ).fetchall()
+
+
+def pause_flusher(monkeypatch):
+    """Make sqlite3.connect block inside the thread named 'flusher'."""
+    entered, release = threading.Event(), threading.Event()
+
+    def connect(*args, **kwargs):
+        if threading.current_thread().name == "flusher":
+            entered.set()
+            release.wait(5)
+        return _real_connect(*args, **kwargs)
+
+    monkeypatch.setattr(lunch.sqlite3, "connect", connect)
+    return entered, release
+
+
+def test_recent_place_ids_sees_pending_choice():
+    assert lunch.record_choice("U1", "P1")
+    assert history_rows("U1") == []
+    assert lunch.recent_place_ids("U1") == {"P1"}
+
+    lunch.flush_choices()
+    assert history_rows("U1") == [("P1",)]
+    assert lunch.recent_place_ids("U1") == {"P1"}
+
+
+def test_recent_place_ids_sees_inflight_choice(monkeypatch):
+    lunch.record_choice("U1", "P1")
+    entered, release = pause_flusher(monkeypatch)
+    flusher = threading.Thread(target=lunch.flush_choices, name="flusher")
+    flusher.start()
+    assert entered.wait(5)
+
+    assert lunch._pending_choices == {}
+    assert lunch.recent_place_ids("U1") == {"P1"}
+
+    release.set()
+    flusher.join(5)
+    assert lunch.recent_place_ids("U1") == {"P1"}
+
+
+def test_pending_choice_replaces_todays_flushed_choice():
+    lunch.record_choice("U1", "P1")
+    lunch.flush_choices()
+    lunch.record_choice("U1", "P2")
+    assert lunch.recent_place_ids("U1") == {"P2"}
+
+
+def test_older_batch_cannot_overwrite_newer_choice(monkeypatch):
+    lunch.record_choice("U1", "P1")
+    entered, release = pause_flusher(monkeypatch)
+    first = threading.Thread(target=lunch.flush_choices, name="flusher")
+    first.start()
+    assert entered.wait(5)
+
+    lunch.record_choice("U1", "P2")
+    second = threading.Thread(target=lunch.flush_choices)
+    second.start()
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert history_rows("U1") == [("P2",)]
+    assert not lunch.record_choice("U1", "P2")
+
+
+def test_failed_flush_is_retried(monkeypatch):
+    lunch.record_choice("U1", "P1")
+
+    def broken_connect(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(lunch.sqlite3, "connect", broken_connect)
+    lunch.flush_choices()
+    monkeypatch.setattr(lunch.sqlite3, "connect", _real_connect)
+
+    assert lunch._inflight_choices == {}
+    assert lunch.pending_choices_for("U1")
+    assert lunch.recent_place_ids("U1") == {"P1"}
+
+    lunch.flush_choices()
+    assert lunch.pending_choices_for("U1") == {}
+    assert history_rows("U1") == [("P1",)]
+
+
+def test_duplicate_detected_after_restart():
+    with _real_connect(lunch.DB_PATH) as conn:
+        conn.execute(
+            "INSERT INTO user_history (user_id, place_id, chosen_at) VALUES (?,?,?)",
+            ("U1", "P1", datetime.now().isoformat()),
+        )
+    assert not lunch.record_choice("U1", "P1")
+    assert lunch.record_choice("U1", "P2")
+
+
+def test_inline_flush_does_not_wait_for_running_flush(monkeypatch):
+    monkeypatch.setattr(lunch, "HISTORY_MAX_PENDING", 1)
+    lunch._pending_choices[("U1", "2000-01-01")] = ("P1", "2000-01-01T12:00:00")
+    entered, release = pause_flusher(monkeypatch)
+    flusher = threading.Thread(target=lunch.flush_choices, name="flusher")
+    flusher.start()
+    assert entered.wait(5)
+
+    tap = threading.Thread(target=lunch.record_choice, args=("U2", "P2"))
+    tap.start()
+    tap.join(1)
+    assert not tap.is_alive()
+    assert lunch.pending_choices_for("U2")
+
+    release.set()
+    flusher.join(5)
+
+
+def test_no_inline_flush_while_db_failing(monkeypatch):
+    monkeypatch.setattr(lunch, "HISTORY_MAX_PENDING", 1)
+    calls = []
+
+    def broken_connect(*args, **kwargs):
+        calls.append(threading.current_thread().name)
+        raise sqlite3.OperationalError("database is locked")
+
+    lunch._pending_choices[("U1", "2000-01-01")] = ("P1", "2000-01-01T12:00:00")
+    monkeypatch.setattr(lunch.sqlite3, "connect", broken_connect)
+    lunch.flush_choices()
+    assert lunch._flush_failing
+
+    calls.clear()
+    lunch._flushed_choices[("U2", datetime.now().date().isoformat())] = None
+    assert lunch.record_choice("U2", "P2")
+    assert calls == []
+    assert len(lunch._pending_choices) == 2
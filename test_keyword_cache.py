@@ -0,0 +1,122 @@
+"""Tests for the 「搜尋」 keyword fallback cache (keyword_fallback / keyword_cache).
+
+Run:
+$ python -m pytest -q test_keyword_cache.py
+
+Uses a temporary SQLite file; Google APIs are never called.
+"""
+
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+for mod in ("flask", "linebot", "requests", "apscheduler"):
+    pytest.importorskip(mod)
+
+ROOT = Path(__file__).resolve().parent
+sys.path.append(str(ROOT))
+
+# lunch_bot 在 import 時就檢查憑證並啟動排程；給假值並拉長自動 flush 間隔
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ["HISTORY_FLUSH_SECONDS"] = "3600"
+
+import lunch_bot as lunch  # noqa: E402
+
+
+def place(place_id: str) -> dict:
+    return {
+        "place_id": place_id,
+        "name": f"店 {place_id}",
+        "geometry": {"location": {"lat": 24.18, "lng": 120.61}},
+        "types": ["restaurant"],
+    }
+
+
+@pytest.fixture(autouse=True)
+def temp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(lunch, "DB_PATH", tmp_path / "lunch.db")
+    monkeypatch.setattr(lunch, "company_location", lambda: (24.18, 120.61))
+    lunch.init_db()
+
+
+@pytest.fixture
+def fetch(monkeypatch):
+    """Replace fetch_keyword_places; set `.result` and inspect `.calls`."""
+    class FakeFetch:
+        result = ([], True)
+        calls: list[str] = []
+
+        def __call__(self, lat, lng, keyword):
+            self.calls.append(keyword)
+            return self.result
+
+    fake = FakeFetch()
+    fake.calls = []
+    monkeypatch.setattr(lunch, "fetch_keyword_places", fake)
+    return fake
+
+
+def test_cache_hit_makes_no_api_call(fetch):
+    lunch.cache_keyword_ids("牛肉麵", {"K1", "K2"})
+    assert lunch.keyword_fallback("牛肉麵") == {"K1", "K2"}
+    assert fetch.calls == []
+
+
+def test_live_result_is_merged_and_cached(fetch):
+    fetch.result = ([place("K1")], True)
+    assert lunch.keyword_fallback("牛肉麵") == {"K1"}
+    assert lunch.cached_keyword_ids("牛肉麵") == {"K1"}
+    assert [r[0] for r in lunch.query_places(place_ids={"K1"})] == ["K1"]
+
+    assert lunch.keyword_fallback("牛肉麵") == {"K1"}
+    assert fetch.calls == ["牛肉麵"]
+
+
+def test_empty_result_is_cached_and_served(fetch):
+    assert lunch.keyword_fallback("不存在的菜") == set()
+    assert lunch.cached_keyword_ids("不存在的菜") == set()
+    assert lunch.keyword_fallback("不存在的菜") == set()
+    assert fetch.calls == ["不存在的菜"]
+
+
+def test_partial_result_is_returned_but_not_cached(fetch):
+    fetch.result = ([place("K1")], False)
+    assert lunch.keyword_fallback("咖哩") == {"K1"}
+    assert lunch.cached_keyword_ids("咖哩") is None
+
+    lunch.keyword_fallback("咖哩")
+    assert fetch.calls == ["咖哩", "咖哩"]
+
+
+def test_expired_entry_triggers_refetch(fetch):
+    stale = (datetime.utcnow() - lunch.KEYWORD_CACHE_TTL - timedelta(minutes=1)).isoformat()
+    with sqlite3.connect(lunch.DB_PATH) as conn:
+        conn.execute(
+            "INSERT INTO keyword_cache (keyword, place_ids, cached_at) VALUES (?,?,?)",
+            ("拉麵", "OLD", stale),
+        )
+    assert lunch.cached_keyword_ids("拉麵") is None
+
+    fetch.result = ([place("K1")], True)
+    assert lunch.keyword_fallback("拉麵") == {"K1"}
+    assert fetch.calls == ["拉麵"]
+
+
+def test_width_case_and_spacing_share_one_key(fetch):
+    assert lunch.normalize_keyword("  ＢＥＥＦ　 Noodle ") == "beef noodle"
+    lunch.cache_keyword_ids("beef noodle", {"K1"})
+    assert lunch.keyword_fallback("Beef  NOODLE") == {"K1"}
+    assert lunch.keyword_fallback("ｂｅｅｆ ｎｏｏｄｌｅ") == {"K1"}
+    assert fetch.calls == []
+
+
+def test_query_places_with_empty_place_ids_returns_nothing():
+    lunch.upsert_places([place("K1")])
+    assert lunch.query_places(place_ids=set()) == []
+    assert lunch.query_places() != []
@@ -0,0 +1,101 @@
+"""Tests for /callback request profiling (StackSampler / dump_profiles).
+
+Run:
+$ python -m pytest -q test_profiling.py
+"""
+
+import os
+import pstats
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+for mod in ("flask", "linebot", "requests", "apscheduler"):
+    pytest.importorskip(mod)
+
+ROOT = Path(__file__).resolve().parent
+sys.path.append(str(ROOT))
+
+# lunch_bot 在 import 時就檢查憑證並啟動排程；給假值並拉長自動 flush 間隔
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ["HISTORY_FLUSH_SECONDS"] = "3600"
+
+import lunch_bot as lunch  # noqa: E402
+
+
+def request_work():
+    time.sleep(0.05)
+
+
+def background_work(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def sampled_names(sampler) -> set[str]:
+    return {func[2] for func in pstats.Stats(sampler).stats}
+
+
+def test_sampler_only_sees_calling_thread():
+    stop = threading.Event()
+    noise = threading.Thread(target=background_work, args=(stop,))
+    noise.start()
+    try:
+        sampler = lunch.StackSampler()
+        sampler.runcall(request_work)
+    finally:
+        stop.set()
+        noise.join()
+
+    names = sampled_names(sampler)
+    assert "request_work" in names
+    assert "background_work" not in names
+    assert "runcall" not in names
+
+
+def test_sampler_stats_merge_into_pstats():
+    a, b = lunch.StackSampler(), lunch.StackSampler()
+    a.runcall(request_work)
+    b.runcall(request_work)
+    total = pstats.Stats()
+    total.add(a, b)
+    key = next(k for k in total.stats if k[2] == "request_work")
+    cc, nc, tt, ct, callers = total.stats[key]
+    assert nc == cc > 0
+    assert 0.05 <= ct < 1
+
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(lunch, "PROFILE_DIR", tmp_path / "profiles")
+    yield lunch.PROFILE_DIR
+    lunch._profile_windows.clear()
+    lunch._profile_dirty.clear()
+
+
+def test_failed_dump_keeps_past_hour_for_retry(profile_dir, monkeypatch):
+    sampler = lunch.StackSampler()
+    sampler.runcall(request_work)
+    past = "20000101-11"
+    lunch._profile_windows[past] = pstats.Stats(sampler)
+    lunch._profile_dirty.add(past)
+
+    def broken_dump(self, filename):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(pstats.Stats, "dump_stats", broken_dump)
+    lunch.dump_profiles()
+    assert past in lunch._profile_windows
+    assert past in lunch._profile_dirty
+
+    monkeypatch.undo()
+    monkeypatch.setattr(lunch, "PROFILE_DIR", profile_dir)
+    lunch.dump_profiles()
+    assert (profile_dir / f"callback-{past}.prof").exists()
+    assert past not in lunch._profile_windows
+    assert not lunch._profile_dirty
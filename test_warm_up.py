@@ -0,0 +1,68 @@
+"""Tests for the pre-lunch cache warm-up (warm_up / bubble_for_row).
+
+Run:
+$ python -m pytest -q test_warm_up.py
+
+Uses a temporary SQLite file; photo redirects are never fetched.
+"""
+
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+for mod in ("flask", "linebot", "requests", "apscheduler"):
+    pytest.importorskip(mod)
+
+ROOT = Path(__file__).resolve().parent
+sys.path.append(str(ROOT))
+
+# lunch_bot 在 import 時就檢查憑證並啟動排程；給假值並拉長自動 flush 間隔
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ["HISTORY_FLUSH_SECONDS"] = "3600"
+
+import lunch_bot as lunch  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def warm_env(tmp_path, monkeypatch):
+    monkeypatch.setattr(lunch, "DB_PATH", tmp_path / "lunch.db")
+    # Bubble 只需記下用了哪個圖片網址
+    monkeypatch.setattr(lunch, "build_bubble", lambda **kw: kw["photo_url"])
+    monkeypatch.setattr(lunch, "_photo_url_cache", {})
+    monkeypatch.setattr(lunch, "_bubble_cache", {})
+    lunch.init_db()
+    with sqlite3.connect(lunch.DB_PATH) as conn:
+        conn.executemany(
+            "INSERT INTO places (place_id, name, rating, types, price_level, photo_ref) "
+            "VALUES (?,?,?,?,?,?)",
+            [(f"P{i:02d}", f"店 {i}", 5 - i / 10, "restaurant", 1, f"ref{i:02d}")
+             for i in range(20)],
+        )
+
+
+def test_warm_up_covers_rows_pulled_up_by_exclusion(monkeypatch):
+    monkeypatch.setattr(lunch, "resolve_photo_url", lambda ref: f"https://img/{ref}")
+    lunch.warm_up()
+
+    exclude = {f"P{i:02d}" for i in range(lunch.RECENT_DAYS + 1)}
+    for row in lunch.query_places(exclude_ids=exclude):
+        assert row in lunch._bubble_cache
+        assert lunch.bubble_for_row(row) == f"https://img/{row[-1]}"
+
+
+def test_reply_during_warm_up_does_not_pin_unresolved_photo(monkeypatch):
+    top = lunch.query_places(limit=1)[0]
+
+    def resolve(ref):
+        # 模擬預熱途中有人查詢同一家
+        lunch.bubble_for_row(top)
+        return f"https://img/{ref}"
+
+    monkeypatch.setattr(lunch, "resolve_photo_url", resolve)
+    lunch.warm_up()
+    assert lunch.bubble_for_row(top) == f"https://img/{top[-1]}"